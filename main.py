@@ -1,41 +1,167 @@
+import atexit
+import hashlib
 import logging
 import os
 import platform
+import signal
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 
 import schedule as schedule
 import yagmail as yagmail
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
+# Third-party ad/tracker hosts, none of which carry article content.
+BLOCKED_HOSTS = frozenset({
+    'doubleclick.net',
+    'googlesyndication.com',
+    'googletagmanager.com',
+    'googletagservices.com',
+    'google-analytics.com',
+    'googleadservices.com',
+    'adservice.google.com',
+    'facebook.net',
+    'hotjar.com',
+    'gemius.pl',
+    'criteo.com',
+    'taboola.com',
+})
 
-def scroll_to_bottom(driver: WebDriver, num_scrolls: int) -> None:
-    for _ in range(num_scrolls):
-        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-        time.sleep(5)
+# Fonts and media are never part of the scraped article HTML. Images are already off through the content setting and
+# blink-settings in get_driver, stylesheets stay because lazy loading needs the layout.
+BLOCKED_EXTENSIONS = frozenset({
+    'woff', 'woff2', 'ttf', 'otf', 'eot',
+    'mp4', 'webm', 'mp3',
+})
+
+URL = 'https://infopigula.pl/#/'
+SITE_ORIGIN = 'https://infopigula.pl'
+
+# Single source for the page's selectors, the locators and the injected scripts below are all built from them.
+DATE_CHOOSER_SELECTOR = 'div.content-date'
+ARTICLE_SELECTOR = 'div.article__content'
+DATE_CHOOSER_LOCATOR = (By.CSS_SELECTOR, DATE_CHOOSER_SELECTOR)
+ARTICLE_LOCATOR = (By.CSS_SELECTOR, ARTICLE_SELECTOR)
+
+# Kept between runs so the HTTP cache survives and static assets are not re-downloaded every week.
+# Every concurrently running browser gets its own subdirectory, Chrome locks a profile while it is in use.
+PROFILE_DIR = os.path.abspath('.chrome-profile')
+
+# Serialises the first span of every article in the browser, so the page is never shipped to Python and re-parsed.
+ARTICLE_SPANS_JS = '''
+return Array.from(document.querySelectorAll(arguments[0]))
+    .map(article => article.querySelector('span'))
+    .filter(Boolean)
+    .map(span => span.outerHTML);
+'''
+
+# Upper bound for every execute_async_script call, set explicitly instead of relying on the session default.
+SCRIPT_TIMEOUT_SECONDS = 30
+# How long a click waits for the article list to be re-rendered before carrying on anyway, matches the old fixed sleeps.
+RELOAD_FALLBACK_SECONDS = 15
+
+# Shared prelude of the async scripts below, which run a whole click-and-wait sequence in a single WebDriver call.
+# waitFor re-checks its predicate on every DOM mutation. clickAndAwaitReload resolves on the first mutation that adds an
+# article to the page, or after the fallback delay if the list is never re-rendered, e.g. the range was already chosen.
+CLICK_AND_AWAIT_RELOAD_JS = '''
+const done = arguments[arguments.length - 1];
+const {reloadFallbackMs, articleSelector, dateChooserSelector} = arguments[0];
+const waitFor = (predicate, callback) => {
+    const found = predicate();
+    if (found) {
+        callback(found);
+        return;
+    }
+    const observer = new MutationObserver(() => {
+        const found = predicate();
+        if (found) {
+            observer.disconnect();
+            callback(found);
+        }
+    });
+    observer.observe(document.body, {childList: true, subtree: true});
+};
+const containsArticle = node => node instanceof Element
+    && (node.matches(articleSelector) || node.querySelector(articleSelector) !== null);
+const clickAndAwaitReload = element => {
+    let observer = null;
+    let fallback = null;
+    const finish = () => {
+        observer.disconnect();
+        clearTimeout(fallback);
+        done();
+    };
+    observer = new MutationObserver(mutations => {
+        if (mutations.some(mutation => Array.from(mutation.addedNodes).some(containsArticle))) {
+            finish();
+        }
+    });
+    observer.observe(document.body, {childList: true, subtree: true});
+    fallback = setTimeout(finish, reloadFallbackMs);
+    element.click();
+};
+'''
+
+SET_ONE_WEEK_PERIOD_JS = CLICK_AND_AWAIT_RELOAD_JS + '''
+document.querySelector(dateChooserSelector).click();
+waitFor(() => document.querySelector('div.options__list-content [id="7"]'), clickAndAwaitReload);
+'''
+
+MOVE_TO_WORD_NEWS_JS = CLICK_AND_AWAIT_RELOAD_JS + '''
+clickAndAwaitReload(document.getElementById('global'));
+'''
 
+CLICK_AND_AWAIT_RELOAD_ARGS = {
+    'reloadFallbackMs': RELOAD_FALLBACK_SECONDS * 1000,
+    'articleSelector': ARTICLE_SELECTOR,
+    'dateChooserSelector': DATE_CHOOSER_SELECTOR,
+}
 
-# def get_driver() -> webdriver.Chrome:
-#     op = webdriver.ChromeOptions()
-#     op.add_argument('--headless')
-#     op.add_argument("window-size=1920,1080")  # Specify resolution
-#     # options.add_argument("--no-sandbox")
-#     # options.add_argument("--disable-dev-shm-usage")
-#     # options.add_argument("--disable-gpu")
+# Browsers are started on the first run and reused by every following one, keyed by profile name.
+_DRIVERS: dict[str, WebDriver] = {}
 
-#     # Define a user agent
-#     op.add_argument(
-#         "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/2b7c7"
-#     )
-#     return webdriver.Chrome(service=ChromeService(ChromeDriverManager().install()), options=op)
+# Digest of the last page that was successfully emailed, an identical page is neither rewritten nor sent again.
+_LAST_SENT_PAGE_HASH: str | None = None
 
-def get_driver() -> webdriver.Chrome:
+PAGE_TEMPLATE = '''<!DOCTYPE html>
+<html>
+    <head>
+      <meta charset="UTF-8">
+      <title>Title of the Webpage</title>
+    </head>
+    <body>
+        <h2>Polska</h2>
+{polska}
+<h2>Świat</h2>
+{swiat}
+    </body>
+</html>
+'''
+
+
+def scroll_to_bottom(driver: WebDriver, num_scrolls: int, timeout: float = 8) -> None:
+    for _ in range(num_scrolls):
+        last_height = driver.execute_script("return document.body.scrollHeight")
+        driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
+        try:
+            WebDriverWait(driver, timeout).until(
+                lambda d: d.execute_script("return document.body.scrollHeight") > last_height
+            )
+        except TimeoutException:
+            # Nothing more got lazy-loaded.
+            break
+
+
+def get_driver(profile: str) -> webdriver.Chrome:
     system = platform.system()
     if system not in {"Windows", "Linux"}:
         raise ValueError("This driver only works on Windows and Linux systems.")
@@ -49,8 +175,18 @@ def get_driver() -> webdriver.Chrome:
     options.add_argument('--disable-gpu')
     options.add_argument('--log-level=3')
     options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
     options.add_argument("--disable-extensions")
     options.add_argument("--disable-plugins-discovery")
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_argument("--disable-features=Translate,MediaRouter,OptimizationHints")
+    options.add_argument("--disable-background-networking")
+    options.add_argument("--disable-sync")
+    options.add_argument("--no-default-browser-check")
+    options.add_argument("--disable-renderer-backgrounding")
+    options.add_argument(f"--user-data-dir={os.path.join(PROFILE_DIR, profile)}")
+    # The SPA fetches its content after DOMContentLoaded anyway and every step waits for the elements it needs.
+    options.page_load_strategy = 'eager'
 
     if browser == 'chrome':
         options.binary_location = "/usr/bin/chromium-browser"
@@ -62,84 +198,117 @@ def get_driver() -> webdriver.Chrome:
         "Chrome/58.0.3029.110 Safari/2b7c7"
     )
     if browser == "chrome":
-        return webdriver.Chrome(options, Service(executable_path="/usr/bin/chromedriver"))
+        driver = webdriver.Chrome(options, Service(executable_path="/usr/bin/chromedriver"))
     else:
-        return webdriver.Chrome(options=options)
+        driver = webdriver.Chrome(options=options)
+    try:
+        driver.set_script_timeout(SCRIPT_TIMEOUT_SECONDS)
+        block_unneeded_requests(driver)
+    except Exception:
+        # A running browser keeps its --user-data-dir locked, every later launch would fail.
+        driver.quit()
+        raise
+    return driver
 
 
-def get_news(driver: WebDriver) -> str:
-    html = driver.page_source
-    soup = BeautifulSoup(html, 'html.parser')
-    articles = soup.find_all('div', class_='article__content')
-    spans = [art.find_all('span') for art in articles]
-    spans = [span[0] for span in spans if span]
-    spans = [f'{span.prettify()} <hr>' for span in spans if span]
-    html = '\n'.join(spans)
-    return html
+def block_unneeded_requests(driver: WebDriver) -> None:
+    urls = [f'*{host}/*' for host in sorted(BLOCKED_HOSTS)]
+    for extension in sorted(BLOCKED_EXTENSIONS):
+        urls += [f'*.{extension}', f'*.{extension}?*']
+    driver.execute_cdp_cmd('Network.enable', {})
+    driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': urls})
 
 
-def set_one_week_period(driver: WebDriver) -> None:
-    range_chooser = driver.find_element(By.CSS_SELECTOR, 'div.content-date')
-    range_chooser.click()
+def get_news(driver: WebDriver) -> str:
+    spans = driver.execute_script(ARTICLE_SPANS_JS, ARTICLE_SELECTOR)
+    return '\n'.join(f'{span} <hr>' for span in spans)
 
-    WebDriverWait(driver, 5).until(EC.visibility_of_element_located((By.CSS_SELECTOR, 'div.options__list-content')))
 
-    list_content_div = driver.find_element(By.CSS_SELECTOR, 'div.options__list-content')
-    nested_div = list_content_div.find_element(By.ID, '7')
-    nested_div.click()
-    time.sleep(15)
+def set_one_week_period(driver: WebDriver) -> None:
+    driver.execute_async_script(SET_ONE_WEEK_PERIOD_JS, CLICK_AND_AWAIT_RELOAD_ARGS)
 
 
 def move_to_word_news(driver: WebDriver) -> None:
-    word_button = driver.find_element(By.ID, 'global')
-    word_button.click()
-    time.sleep(10)
+    driver.execute_async_script(MOVE_TO_WORD_NEWS_JS, CLICK_AND_AWAIT_RELOAD_ARGS)
 
 
 def send_mail(html_content: str) -> None:
     email_subject = 'Infopiguła news'
-    yag = yagmail.SMTP(os.getenv('SRC_MAIL'), os.getenv('SRC_PWD'), port=587, smtp_starttls=True, smtp_ssl=False)
-    yag.send(to=os.getenv('DST_MAIL'), subject=email_subject, contents=(html_content, 'text/html'))
+    with yagmail.SMTP(os.getenv('SRC_MAIL'), os.getenv('SRC_PWD'), port=587, smtp_starttls=True, smtp_ssl=False) as yag:
+        result = yag.send(to=os.getenv('DST_MAIL'), subject=email_subject, contents=(html_content, 'text/html'))
+    # yagmail swallows repeated SMTPServerDisconnected and returns False, a successful send returns a (possibly empty) dict.
+    if result is False:
+        raise RuntimeError('Email was not sent, the SMTP server kept disconnecting')
+
+
+def scrape_news(world_news: bool) -> str:
+    profile = 'swiat' if world_news else 'polska'
+    driver = _DRIVERS.get(profile)
+    try:
+        if driver is None:
+            driver = _DRIVERS[profile] = get_driver(profile)
+            driver.maximize_window()
+        # Resets site state kept in the persistent profile, the HTTP cache is left alone. WebDriver's delete_all_cookies
+        # only covers the current document, which here is still about:blank.
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd(
+            'Storage.clearDataForOrigin',
+            {'origin': SITE_ORIGIN, 'storageTypes': 'local_storage,session_storage,indexeddb'},
+        )
+        driver.get(URL)
+        WebDriverWait(driver, 15).until(EC.presence_of_element_located(DATE_CHOOSER_LOCATOR))
+        # The range and tab clicks no longer need an already rendered article, so a slow first render is tolerated.
+        with suppress(TimeoutException):
+            WebDriverWait(driver, 15).until(EC.presence_of_element_located(ARTICLE_LOCATOR))
+
+        set_one_week_period(driver)
+        if world_news:
+            move_to_word_news(driver)
+        scroll_to_bottom(driver, num_scrolls=4)
+        news = get_news(driver)
+        # Unloads the page while the browser idles until the next run, so that run starts with a real navigation.
+        driver.get('about:blank')
+        return news
+    except Exception:
+        # The session may be broken, e.g. chromedriver died during the idle week and every command now fails with a
+        # urllib3 connection error rather than a WebDriverException. The next run starts a fresh browser.
+        _DRIVERS.pop(profile, None)
+        if driver is not None:
+            with suppress(Exception):
+                driver.quit()
+        raise
+
+
+def quit_drivers() -> None:
+    # A browser left running keeps its profile locked, so the next process could not start one on it.
+    while _DRIVERS:
+        _, driver = _DRIVERS.popitem()
+        with suppress(Exception):
+            driver.quit()
 
 
 def main() -> None:
+    global _LAST_SENT_PAGE_HASH
     if platform.system() == "Linux":
         os.nice(10)
-        
-    load_dotenv()
-    driver = get_driver()
-    driver.maximize_window()
-    url = 'https://infopigula.pl/#/'
-    driver.get(url)
-    WebDriverWait(driver, 15).until(EC.presence_of_element_located((By.CSS_SELECTOR, 'div.content-date')))
 
-    set_one_week_period(driver)
-    scroll_to_bottom(driver, num_scrolls=4)
+    # Both sections are independent page loads, so each gets its own browser and they are scraped side by side.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        polska, swiat = executor.map(scrape_news, (False, True))
 
-    page = '''<!DOCTYPE html>
-<html>
-    <head>
-      <meta charset="UTF-8">
-      <title>Title of the Webpage</title>
-    </head>
-    <body>
-        <h2>Polska</h2>\n
-'''
-    page += get_news(driver)
+    page = PAGE_TEMPLATE.format(polska=polska, swiat=swiat)
+    data = page.encode('utf-8')
+    page_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+    if page_hash == _LAST_SENT_PAGE_HASH:
+        logging.info('News did not change since the last email, skipping')
+        return
 
-    move_to_word_news(driver)
-    scroll_to_bottom(driver, num_scrolls=4)
-    page += '<h2>Świat</h2>\n'
-    page += get_news(driver)
-
-    page += '''
-    </body>
-</html>
-'''
-    with open('index.html', 'wt', encoding='utf-8') as f:
-        f.write(page)
+    with open('index.html.tmp', 'wb') as f:
+        f.write(data)
+    os.replace('index.html.tmp', 'index.html')
 
     send_mail(page)
+    _LAST_SENT_PAGE_HASH = page_hash
 
 
 if __name__ == '__main__':
@@ -149,16 +318,27 @@ if __name__ == '__main__':
     )
     logging.getLogger("selenium").setLevel(logging.WARNING)
     logging.getLogger("urllib3").setLevel(logging.WARNING)
+    load_dotenv()
+    atexit.register(quit_drivers)
+    # SIGTERM would otherwise end the process without running atexit handlers.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     schedule.every().saturday.at("12:00").do(main)
     i = 0
     while True:
         try:
+            idle = schedule.idle_seconds()
+            if idle is None:
+                break
+            if idle > 0:
+                # Capped so a clock change is picked up within the hour.
+                time.sleep(min(idle, 3600))
             schedule.run_pending()
-            time.sleep(10)
         except Exception as e:
             logging.exception("An error occurred:")
             i += 1
             if i > 10:
                 logging.error('Exiting program due to too many errors')
                 break
+            time.sleep(10)
+    quit_drivers()
     # main()